@@ -3,12 +3,14 @@ import logging
 import sys
 import time
 import math
+import zipfile
 
 import numpy as np
 import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch.autograd import Variable
+from torch.amp import autocast, GradScaler
 from torchvision import datasets, transforms
 
 from models import *
@@ -23,8 +25,28 @@ from utils import *
 mu = torch.tensor(cifar10_mean).view(3,1,1).cuda()
 std = torch.tensor(cifar10_std).view(3,1,1).cuda()
 
+# clean inputs arrive as raw [0,255] pixels, so (X/255 - mu)/std is folded into X*scale + shift for a single addcmul kernel
+norm_scale = 1/(255*std)
+norm_shift = -mu/std
+
 def normalize(X):
-    return (X - mu)/std
+    return torch.addcmul(norm_shift, X, norm_scale)
+
+mu_np = np.array(cifar10_mean, dtype=np.float32).reshape(3,1,1)
+std_np = np.array(cifar10_std, dtype=np.float32).reshape(3,1,1)
+
+def normalize_array(X):
+    X = np.asarray(X, dtype=np.float32) - mu_np
+    X /= std_np
+    return X
+
+def to_nchw_tensor(X):
+    # uint8 NHWC images -> uint8 NCHW view; the storage stays NHWC (channels_last), so no transpose copy is made
+    return torch.from_numpy(X).permute(0,3,1,2)
+
+def load_adv_examples(path):
+    # shards may hold NumPy arrays, which the weights-only unpickler rejects; mmap only works on the zipfile format
+    return torch.load(path, mmap=zipfile.is_zipfile(path), weights_only=False)
 
 upper_limit, lower_limit = 1,0
 
@@ -33,24 +55,86 @@ def clamp(X, lower_limit, upper_limit):
     return torch.max(torch.min(X, upper_limit), lower_limit)
 
 
+BATCH_KEYS = ('input', 'target', 'adv_input', 'adv_target')
+
+def cast_batch(batch):
+    '''Casts a batch dict already on the GPU: inputs to channels_last float, targets to long'''
+    return {k: t.long() if k.endswith('target') else t.float().contiguous(memory_format=torch.channels_last) for k, t in batch.items()}
+
+def to_device_batch(tensors):
+    '''Moves (input, target[, adv_input, adv_target]) tensors to the GPU as a batch dict, casting after the copy'''
+    return cast_batch({k: t.to(device, non_blocking=True) for k, t in zip(BATCH_KEYS, tensors)})
+
+
 class Batches():
-    def __init__(self, dataset, batch_size, shuffle, set_random_choices=False, num_workers=0, drop_last=False):
+    def __init__(self, dataset, batch_size, shuffle, set_random_choices=False, num_workers=0, drop_last=False, persistent_workers=False, prefetch_factor=2):
         self.dataset = dataset
         self.batch_size = batch_size
         self.set_random_choices = set_random_choices
+        # index the TensorDataset with a whole batch of indices at once instead of collating single samples
+        sampler = torch.utils.data.RandomSampler(dataset) if shuffle else torch.utils.data.SequentialSampler(dataset)
+        # persistent_workers and prefetch_factor are only valid with worker processes
+        worker_kwargs = {'persistent_workers': persistent_workers, 'prefetch_factor': prefetch_factor} if num_workers > 0 else {}
         self.dataloader = torch.utils.data.DataLoader(
-            dataset, batch_size=batch_size, num_workers=num_workers, pin_memory=True, shuffle=shuffle, drop_last=drop_last
+            dataset, batch_size=None, sampler=torch.utils.data.BatchSampler(sampler, batch_size, drop_last), num_workers=num_workers, pin_memory=True, **worker_kwargs
         )
 
     def __iter__(self):
         if self.set_random_choices:
             self.dataset.set_random_choices()
-        return ({'input': x.to(device).float(), 'target': y.to(device).long()} for (x,y) in self.dataloader)
+        return (to_device_batch(b) for b in self.dataloader)
 
     def __len__(self):
         return len(self.dataloader)
 
 
+class GpuBatches():
+    '''Serves batches by slicing a TensorDataset that is kept entirely in GPU memory'''
+    def __init__(self, dataset, batch_size, shuffle, drop_last=False):
+        # keep the tensors in their stored dtype (uint8 for clean images) and cast each batch on the fly
+        self.tensors = {k: t.to(device).contiguous(memory_format=torch.channels_last) if t.dim() == 4 else t.to(device)
+                        for k, t in zip(BATCH_KEYS, dataset.tensors)}
+        self.n = len(dataset)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+
+    def __iter__(self):
+        n = len(self) * self.batch_size if self.drop_last else self.n
+        if self.shuffle:
+            perm = torch.randperm(self.n, device=device)[:n]
+            return (cast_batch({k: t.index_select(0, idx) for k, t in self.tensors.items()}) for idx in perm.split(self.batch_size))
+        return (cast_batch({k: t[i:i+self.batch_size] for k, t in self.tensors.items()}) for i in range(0, n, self.batch_size))
+
+    def __len__(self):
+        if self.drop_last:
+            return self.n // self.batch_size
+        return int(math.ceil(self.n / self.batch_size))
+
+
+class CudaPrefetcher():
+    '''Copies the next batch to the GPU on a side stream while the current batch is being used'''
+    def __init__(self, batches):
+        self.batches = batches
+        self.stream = torch.cuda.Stream()
+
+    def __iter__(self):
+        batches = iter(self.batches)
+        with torch.cuda.stream(self.stream):
+            next_batch = next(batches, None)
+        while next_batch is not None:
+            torch.cuda.current_stream().wait_stream(self.stream)
+            batch = next_batch
+            for t in batch.values():
+                t.record_stream(torch.cuda.current_stream())
+            with torch.cuda.stream(self.stream):
+                next_batch = next(batches, None)
+            yield batch
+
+    def __len__(self):
+        return len(self.batches)
+
+
 def mixup_data(x, y, alpha=1.0):
     '''Returns mixed inputs, pairs of targets, and lambda'''
     if alpha > 0:
@@ -106,6 +190,7 @@ def get_args():
     parser.add_argument('--eval', action='store_true')
     parser.add_argument('--val', action='store_true')
     parser.add_argument('--chkpt-iters', default=20, type=int)
+    parser.add_argument('--clean-iters', default=1, type=int)
     return parser.parse_args()
 
 
@@ -136,6 +221,7 @@ def main():
     np.random.seed(args.seed)
     torch.manual_seed(args.seed)
     torch.cuda.manual_seed(args.seed)
+    torch.backends.cudnn.benchmark = True
 
 
     # setup data loader
@@ -151,26 +237,19 @@ def main():
     test_set = torchvision.datasets.CIFAR10(root='../data', train=False, download=True, transform=transform_test)
 
     if args.attack == "all" :
-        train_data = np.array(train_set.data) / 255.
-        train_data = transpose(train_data).astype(np.float32)
-
+        train_data = np.array(train_set.data)
         train_labels = np.array(train_set.targets)
         
         oversampled_train_data = np.tile(train_data, (11,1,1,1))
         oversampled_train_labels = np.tile(train_labels, (11))
 
-        train_set = list(zip(torch.from_numpy(oversampled_train_data), torch.from_numpy(oversampled_train_labels)))
+        train_set = torch.utils.data.TensorDataset(to_nchw_tensor(oversampled_train_data), torch.from_numpy(oversampled_train_labels))
 
 
     elif args.attack == "combine" :
-        train_data = np.array(train_set.data) / 255.
-        train_data = transpose(train_data).astype(np.float32)
-
+        train_data = np.array(train_set.data)
         train_labels = np.array(train_set.targets)
 
-        oversampled_train_data = train_data.copy()
-        oversampled_train_labels = train_labels.copy()
-
         logger.info("Attacks")
         attacks = args.list.split("_")
         logger.info(attacks)
@@ -178,28 +257,25 @@ def main():
         oversampled_train_data = np.tile(train_data, (len(attacks),1,1,1))
         oversampled_train_labels = np.tile(train_labels, (len(attacks)))
 
-        train_set = list(zip(torch.from_numpy(oversampled_train_data), torch.from_numpy(oversampled_train_labels)))        
+        train_set = torch.utils.data.TensorDataset(to_nchw_tensor(oversampled_train_data), torch.from_numpy(oversampled_train_labels))
     else :
-        train_data = np.array(train_set.data) / 255.
-        train_data = transpose(train_data).astype(np.float32)
-
+        train_data = np.array(train_set.data)
         train_labels = np.array(train_set.targets)
         
-        train_set = list(zip(torch.from_numpy(train_data), torch.from_numpy(train_labels)))
+        train_set = torch.utils.data.TensorDataset(to_nchw_tensor(train_data), torch.from_numpy(train_labels))
 
-    test_data = np.array(test_set.data) / 255.
-    test_data = transpose(test_data).astype(np.float32)
+    test_data = np.array(test_set.data)
     test_labels = np.array(test_set.targets)
 
-    test_set = list(zip(torch.from_numpy(test_data), torch.from_numpy(test_labels)))
+    test_set = torch.utils.data.TensorDataset(to_nchw_tensor(test_data), torch.from_numpy(test_labels))
 
     
     if args.sample != 100 :
         n = len(train_set) 
         n_sample = int(n * args.sample / 100)
         
-        np.random.shuffle(train_set)
-        train_set = train_set[:n_sample]
+        idx = torch.randperm(n, generator=torch.Generator().manual_seed(args.seed))[:n_sample]
+        train_set = torch.utils.data.TensorDataset(*[t[idx] for t in train_set.tensors])
 
     print("")
     print("Train Original Data: ")
@@ -208,9 +284,6 @@ def main():
         
 
     shuffle = False
-        
-    train_batches = Batches(train_set, args.batch_size, shuffle=shuffle)
-    test_batches = Batches(test_set, args.batch_size, shuffle=False)
     
     
     train_adv_images = None
@@ -227,70 +300,56 @@ def main():
     
 
     if args.attack in ATTACK_LIST :
-        adv_train_data = torch.load(train_path)
+        adv_train_data = load_adv_examples(train_path)
         train_adv_images = adv_train_data["adv"]
         train_adv_labels = adv_train_data["label"]
-        adv_test_data = torch.load(test_path)
+        adv_test_data = load_adv_examples(test_path)
         test_adv_images = adv_test_data["adv"]
         test_adv_labels = adv_test_data["label"]        
     elif args.attack in ["ffgsm", "mifgsm", "tpgd"] :
         adv_data = {}
-        adv_data["adv"], adv_data["label"] = torch.load(train_path)
+        adv_data["adv"], adv_data["label"] = load_adv_examples(train_path)
         train_adv_images = adv_data["adv"].numpy()
         train_adv_labels = adv_data["label"].numpy()
         adv_data = {}
-        adv_data["adv"], adv_data["label"] = torch.load(test_path)
+        adv_data["adv"], adv_data["label"] = load_adv_examples(test_path)
         test_adv_images = adv_data["adv"].numpy()
         test_adv_labels = adv_data["label"].numpy()
     elif args.attack == "all" :
-        
+        # collect the shards and concatenate them once below; growing the arrays attack by attack copies O(N^2) bytes
+        train_adv_images, train_adv_labels, test_adv_images, test_adv_labels = [], [], [], []
         for i in range(len(ATTACK_LIST)):
             _adv_dir = "adv_examples/{}/".format(ATTACK_LIST[i])
             train_path = _adv_dir + "train.pth" 
             test_path = _adv_dir + "test.pth"
 
-            adv_train_data = torch.load(train_path)
-            adv_test_data = torch.load(test_path)
+            adv_train_data = load_adv_examples(train_path)
+            adv_test_data = load_adv_examples(test_path)
             
-            if i == 0 :
-                train_adv_images = adv_train_data["adv"]
-                train_adv_labels = adv_train_data["label"]
-                test_adv_images = adv_test_data["adv"]
-                test_adv_labels = adv_test_data["label"]   
-            else :
-#                 print(train_adv_images.shape)
-#                 print(adv_train_data["adv"].shape)
-                train_adv_images = np.concatenate((train_adv_images, adv_train_data["adv"]))
-                train_adv_labels = np.concatenate((train_adv_labels, adv_train_data["label"]))
-                test_adv_images = np.concatenate((test_adv_images, adv_test_data["adv"]))
-                test_adv_labels = np.concatenate((test_adv_labels, adv_test_data["label"]))
+            train_adv_images.append(adv_train_data["adv"])
+            train_adv_labels.append(adv_train_data["label"])
+            test_adv_images.append(adv_test_data["adv"])
+            test_adv_labels.append(adv_test_data["label"])
     elif args.attack == "combine" :
         
         print("Attacks")
         attacks = args.list.split("_")
         print(attacks)
         
+        train_adv_images, train_adv_labels, test_adv_images, test_adv_labels = [], [], [], []
         if args.balanced == None :
             for i in range(len(attacks)):
                 _adv_dir = "adv_examples/{}/".format(attacks[i])
                 train_path = _adv_dir + "train.pth" 
                 test_path = _adv_dir + "test.pth"
 
-                adv_train_data = torch.load(train_path)
-                adv_test_data = torch.load(test_path)
+                adv_train_data = load_adv_examples(train_path)
+                adv_test_data = load_adv_examples(test_path)
 
-                if i == 0 :
-                    train_adv_images = adv_train_data["adv"]
-                    train_adv_labels = adv_train_data["label"]
-                    test_adv_images = adv_test_data["adv"]
-                    test_adv_labels = adv_test_data["label"]   
-                else :
-    #                 print(train_adv_images.shape)
-    #                 print(adv_train_data["adv"].shape)
-                    train_adv_images = np.concatenate((train_adv_images, adv_train_data["adv"]))
-                    train_adv_labels = np.concatenate((train_adv_labels, adv_train_data["label"]))
-                    test_adv_images = np.concatenate((test_adv_images, adv_test_data["adv"]))
-                    test_adv_labels = np.concatenate((test_adv_labels, adv_test_data["label"]))
+                train_adv_images.append(adv_train_data["adv"])
+                train_adv_labels.append(adv_train_data["label"])
+                test_adv_images.append(adv_test_data["adv"])
+                test_adv_labels.append(adv_test_data["label"])
         else :
             proportion_str = args.balanced.split("_")
             proportion = [int(x) for x in proportion_str]
@@ -303,8 +362,8 @@ def main():
                 train_path = _adv_dir + "train.pth" 
                 test_path = _adv_dir + "test.pth"
 
-                adv_train_data = torch.load(train_path)
-                adv_test_data = torch.load(test_path)
+                adv_train_data = load_adv_examples(train_path)
+                adv_test_data = load_adv_examples(test_path)
                 
                 random_state = 0
                 num_samples = 0
@@ -317,45 +376,61 @@ def main():
                 print("Sample")
                 print(n_samples)
 
-                if i == 0 :
-                    train_adv_images = resample(adv_train_data["adv"], n_samples=n_samples, random_state=random_state)
-                    train_adv_labels = resample(adv_train_data["label"], n_samples=n_samples, random_state=random_state)
-                    test_adv_images = resample(adv_test_data["adv"], n_samples=n_samples, random_state=random_state)
-                    test_adv_labels = resample(adv_test_data["label"], n_samples=n_samples, random_state=random_state)   
-                else :
-                    train_adv_images = np.concatenate((train_adv_images, resample(adv_train_data["adv"], n_samples=n_samples, random_state=random_state)))
-                    train_adv_labels = np.concatenate((train_adv_labels, resample(adv_train_data["label"], n_samples=n_samples, random_state=random_state)))
-                    test_adv_images = np.concatenate((test_adv_images, resample(adv_test_data["adv"], n_samples=n_samples, random_state=random_state)))
-                    test_adv_labels = np.concatenate((test_adv_labels, resample(adv_test_data["label"], n_samples=n_samples, random_state=random_state)))
+                # draw the bootstrap indices once and share them between images and labels
+                rng = np.random.default_rng(random_state)
+                idx_train = rng.integers(0, len(adv_train_data["adv"]), size=n_samples)
+                idx_test = rng.integers(0, len(adv_test_data["adv"]), size=n_samples)
 
+                train_adv_images.append(adv_train_data["adv"][idx_train])
+                train_adv_labels.append(adv_train_data["label"][idx_train])
+                test_adv_images.append(adv_test_data["adv"][idx_test])
+                test_adv_labels.append(adv_test_data["label"][idx_test])
 
     else :
         raise ValueError("Unknown adversarial data")
+
+    if args.attack in ["all", "combine"] :
+        train_adv_images = np.concatenate(train_adv_images)
+        train_adv_labels = np.concatenate(train_adv_labels)
+        test_adv_images = np.concatenate(test_adv_images)
+        test_adv_labels = np.concatenate(test_adv_labels)
         
-        
+    # adversarial examples are fixed, so normalize them once up front
+    train_adv_images = normalize_array(train_adv_images)
+    test_adv_images = normalize_array(test_adv_images)
 
     
-    train_adv_set = list(zip(train_adv_images,
-        train_adv_labels))
+    train_adv_set = torch.utils.data.TensorDataset(torch.as_tensor(train_adv_images),
+        torch.as_tensor(train_adv_labels))
     
     if args.sample != 100 :
         n = len(train_adv_set) 
         n_sample = int(n * args.sample / 100)
         
-        np.random.shuffle(train_adv_set)
-        train_adv_set = train_adv_set[:n_sample]
+        idx = torch.randperm(n, generator=torch.Generator().manual_seed(args.seed))[:n_sample]
+        train_adv_set = torch.utils.data.TensorDataset(*[t[idx] for t in train_adv_set.tensors])
         
     print("")
     print("Train Adv Attack Data: ", args.attack)
     print("Len: ", len(train_adv_set))
     print("")
 
-    train_robust_batches = Batches(train_adv_set, args.batch_size, shuffle=shuffle, set_random_choices=False, num_workers=4)
-    
-    test_adv_set = list(zip(test_adv_images,
-        test_adv_labels))
-        
-    test_robust_batches = Batches(test_adv_set, args.batch_size, shuffle=False, num_workers=4)
+    # pair each clean example with the adversarial example at the same index so a single loader serves both
+    n_train = min(len(train_set), len(train_adv_set))
+    train_combined_set = torch.utils.data.TensorDataset(*[t[:n_train] for t in train_set.tensors + train_adv_set.tensors])
+
+    # keep the fixed test sets normalized on the GPU, uploaded before the free-memory check below so it counts them
+    test_X = normalize(test_set.tensors[0].to(device).float().contiguous(memory_format=torch.channels_last))
+    test_y = test_set.tensors[1].to(device).long()
+    test_adv_X = torch.as_tensor(test_adv_images).to(device).contiguous(memory_format=torch.channels_last)
+    test_adv_y = torch.as_tensor(test_adv_labels).to(device).long()
+
+    # upload the whole training set once if it comfortably fits, otherwise stream it from the host
+    train_bytes = sum(t.element_size() * t.nelement() for t in train_combined_set.tensors)
+    if train_bytes < 0.4 * torch.cuda.mem_get_info()[0]:
+        train_batches = GpuBatches(train_combined_set, args.batch_size, shuffle=shuffle)
+    else:
+        train_batches = CudaPrefetcher(Batches(train_combined_set, args.batch_size, shuffle=shuffle, num_workers=4, persistent_workers=True, prefetch_factor=4))
 
 
     epsilon = (args.epsilon / 255.)
@@ -371,6 +446,9 @@ def main():
 
 
     model = nn.DataParallel(model).cuda()
+    model = model.to(memory_format=torch.channels_last)
+    # Dynamo cannot trace DataParallel, so compile the inner module; checkpoints still use the plain wrapper
+    compiled_model = torch.compile(model.module, mode="max-autotune-no-cudagraphs")
     model.train()
 
     if args.l2:
@@ -385,9 +463,10 @@ def main():
     else:
         params = model.parameters()
 
-    opt = torch.optim.SGD(params, lr=args.lr_max, momentum=0.9, weight_decay=5e-4)
+    opt = torch.optim.SGD(params, lr=args.lr_max, momentum=0.9, weight_decay=5e-4, fused=True)
 
     criterion = nn.CrossEntropyLoss()
+    scaler = GradScaler('cuda')
 
     if args.attack == 'free':
         delta = torch.zeros(args.batch_size, 3, 32, 32).cuda()
@@ -426,6 +505,9 @@ def main():
         def lr_schedule(t): 
             return args.lr_max * 0.5 * (1 + np.cos(t / args.epochs * np.pi))
 
+    # evaluate the schedule for every iteration up front instead of once per training step
+    n_train_batches = len(train_batches)
+    lrs = [[lr_schedule(epoch + (i + 1) / n_train_batches) for i in range(n_train_batches)] for epoch in range(epochs)]
 
     best_test_robust_acc = 0
     best_val_robust_acc = 0
@@ -433,6 +515,9 @@ def main():
         start_epoch = args.resume
         model.load_state_dict(torch.load(os.path.join(dirname, f'model_{start_epoch-1}.pth')))
         opt.load_state_dict(torch.load(os.path.join(dirname, f'opt_{start_epoch-1}.pth')))
+        # checkpoints written before mixed precision have no scaler state; those start from a fresh scale
+        if os.path.exists(os.path.join(dirname, f'scaler_{start_epoch-1}.pth')):
+            scaler.load_state_dict(torch.load(os.path.join(dirname, f'scaler_{start_epoch-1}.pth')))
         logger.info(f'Resuming at epoch {start_epoch}')
 
         best_test_robust_acc = torch.load(os.path.join(dirname, f'model_best.pth'))['test_robust_acc']
@@ -450,84 +535,83 @@ def main():
     model.eval()
     
     # Evaluate on original test data
-    test_acc = 0
-    test_n = 0
+    test_acc = torch.zeros((), device=device)
+    test_n = len(test_y)
     
-    for i, batch in enumerate(test_batches):
-        X, y = batch['input'], batch['target']
-
-        clean_input = normalize(X)
-        output = model(clean_input)
-        
-        test_acc += (output.max(1)[1] == y).sum().item()
-        test_n += y.size(0)
+    with torch.inference_mode():
+        for i in range(0, test_n, args.batch_size):
+            output = compiled_model(test_X[i:i+args.batch_size])
+            test_acc += (output.max(1)[1] == test_y[i:i+args.batch_size]).sum()
         
-    logger.info('Intial Accuracy on Original Test Data: %.4f (Test Acc)', test_acc/test_n)
+    logger.info('Intial Accuracy on Original Test Data: %.4f (Test Acc)', test_acc.item()/test_n)
     
-    test_adv_acc = 0
-    test_adv_n = 0
+    test_adv_acc = torch.zeros((), device=device)
+    test_adv_n = len(test_adv_y)
         
-    for i, batch in enumerate(test_robust_batches):                            
-        adv_input = normalize(batch['input'])
-        y = batch['target']
-
-        robust_output = model(adv_input)
-        test_adv_acc += (robust_output.max(1)[1] == y).sum().item()
-        test_adv_n += y.size(0)
+    with torch.inference_mode():
+        for i in range(0, test_adv_n, args.batch_size):
+            robust_output = compiled_model(test_adv_X[i:i+args.batch_size])
+            test_adv_acc += (robust_output.max(1)[1] == test_adv_y[i:i+args.batch_size]).sum()
     
-    logger.info('Intial Accuracy on Adversarial Test Data: %.4f (Test Robust Acc)', test_adv_acc/test_adv_n)
+    logger.info('Intial Accuracy on Adversarial Test Data: %.4f (Test Robust Acc)', test_adv_acc.item()/test_adv_n)
 
     logger.info('Epoch \t Train Time \t Test Time \t LR \t \t Train Loss \t Train Acc \t Train Robust Loss \t Train Robust Acc \t Test Loss \t Test Acc \t Test Robust Loss \t Test Robust Acc')
     for epoch in range(start_epoch, epochs):
         model.train()
         start_time = time.time()
-        train_loss = 0
-        train_acc = 0
-        train_robust_loss = 0
-        train_robust_acc = 0
+        # accumulate metrics on the GPU so the loop never blocks on .item()
+        train_loss = torch.zeros((), device=device)
+        train_acc = torch.zeros((), device=device)
+        train_robust_loss = torch.zeros((), device=device)
+        train_robust_acc = torch.zeros((), device=device)
         train_n = 0
-        for i, (batch, adv_batch) in enumerate(zip(train_batches, train_robust_batches)):
+        train_clean_n = 0
+        for i, batch in enumerate(train_batches):
             if args.eval:
                 break
             X, y = batch['input'], batch['target']
             if args.mixup:
                 X, y_a, y_b, lam = mixup_data(X, y, args.mixup_alpha)
                 X, y_a, y_b = map(Variable, (X, y_a, y_b))
-            lr = lr_schedule(epoch + (i + 1) / len(train_batches))
-            opt.param_groups[0].update(lr=lr)
+            lr = lrs[epoch][i]
+            opt.param_groups[0]['lr'] = lr
             
-            adv_input = normalize(adv_batch['input'])
-            y_adv = adv_batch['target']
-            adv_input.requires_grad = True
-            robust_output = model(adv_input)
-
-
-            if args.mixup:
-                robust_loss = mixup_criterion(criterion, robust_output, y_a, y_b, lam)
-            else:
-                robust_loss = criterion(robust_output, y)
+            adv_input = batch['adv_input']
+            y_adv = batch['adv_target']
+            with autocast('cuda'):
+                robust_output = compiled_model(adv_input)
+                if args.mixup:
+                    robust_loss = mixup_criterion(criterion, robust_output, y_a, y_b, lam)
+                else:
+                    robust_loss = criterion(robust_output, y)
 
             if args.l1:
                 for name,param in model.named_parameters():
                     if 'bn' not in name and 'bias' not in name:
                         robust_loss += args.l1*param.abs().sum()
 
-            opt.zero_grad()
-            robust_loss.backward()
-            opt.step()
-
-            output = model(normalize(X))
-            if args.mixup:
-                loss = mixup_criterion(criterion, output, y_a, y_b, lam)
-            else:
-                loss = criterion(output, y)
+            opt.zero_grad(set_to_none=True)
+            scaler.scale(robust_loss).backward()
+            scaler.step(opt)
+            scaler.update()
 
-            train_robust_loss += robust_loss.item() * y_adv.size(0)
-            train_robust_acc += (robust_output.max(1)[1] == y_adv).sum().item()
-            train_loss += loss.item() * y.size(0)
-            train_acc += (output.max(1)[1] == y).sum().item()
+            train_robust_loss += robust_loss.detach() * y_adv.size(0)
+            train_robust_acc += (robust_output.max(1)[1] == y_adv).sum()
             train_n += y.size(0)
+
+            # the train-mode clean pass also updates BatchNorm running stats, so --clean-iters > 1 changes the model
+            if i % args.clean_iters == 0:
+                with torch.no_grad(), autocast('cuda'):
+                    output = compiled_model(normalize(X))
+                    if args.mixup:
+                        loss = mixup_criterion(criterion, output, y_a, y_b, lam)
+                    else:
+                        loss = criterion(output, y)
+                train_loss += loss.detach() * y.size(0)
+                train_acc += (output.max(1)[1] == y).sum()
+                train_clean_n += y.size(0)
             
+        train_loss, train_acc, train_robust_loss, train_robust_acc = [t.item() for t in (train_loss, train_acc, train_robust_loss, train_robust_acc)]
 
         train_time = time.time()
 
@@ -535,48 +619,46 @@ def main():
         
         # Evaluate on test data
         model.eval()
-        test_loss = 0
-        test_acc = 0
-        test_n = 0
+        test_loss = torch.zeros((), device=device)
+        test_acc = torch.zeros((), device=device)
+        test_n = len(test_y)
         
-        test_robust_loss = 0
-        test_robust_acc = 0
-        test_robust_n = 0
+        test_robust_loss = torch.zeros((), device=device)
+        test_robust_acc = torch.zeros((), device=device)
+        test_robust_n = len(test_adv_y)
         
-        for i, batch in enumerate(test_batches):
-            X, y = batch['input'], batch['target']
-            
-            clean_input = normalize(X)
-            output = model(clean_input)
-            loss = criterion(output, y)
+        with torch.inference_mode():
+            for i in range(0, test_n, args.batch_size):
+                y = test_y[i:i+args.batch_size]
+                output = compiled_model(test_X[i:i+args.batch_size])
+                loss = criterion(output, y)
 
-            test_loss += loss.item() * y.size(0)
-            test_acc += (output.max(1)[1] == y).sum().item()
-            test_n += y.size(0)
-            
-        for i, batch in enumerate(test_robust_batches):                            
-            adv_input = normalize(batch['input'])
-            y = batch['target']
+                test_loss += loss * y.size(0)
+                test_acc += (output.max(1)[1] == y).sum()
+                
+            for i in range(0, test_robust_n, args.batch_size):
+                y = test_adv_y[i:i+args.batch_size]
+                robust_output = compiled_model(test_adv_X[i:i+args.batch_size])
+                robust_loss = criterion(robust_output, y)
 
-            robust_output = model(adv_input)
-            robust_loss = criterion(robust_output, y)
+                test_robust_loss += robust_loss * y.size(0)
+                test_robust_acc += (robust_output.max(1)[1] == y).sum()
 
-            test_robust_loss += robust_loss.item() * y.size(0)
-            test_robust_acc += (robust_output.max(1)[1] == y).sum().item()
-            test_robust_n += y.size(0)
+        test_loss, test_acc, test_robust_loss, test_robust_acc = [t.item() for t in (test_loss, test_acc, test_robust_loss, test_robust_acc)]
 
         test_time = time.time()
 
 
         logger.info('%d \t %.1f \t \t %.1f \t \t %.4f \t %.4f \t %.4f \t %.4f \t \t %.4f \t \t %.4f \t %.4f \t %.4f \t \t %.4f',
             epoch, train_time - start_time, test_time - train_time, lr,
-            train_loss/train_n, train_acc/train_n, train_robust_loss/train_n, train_robust_acc/train_n,
+            train_loss/max(train_clean_n, 1), train_acc/max(train_clean_n, 1), train_robust_loss/train_n, train_robust_acc/train_n,
             test_loss/test_n, test_acc/test_n, test_robust_loss/test_robust_n, test_robust_acc/test_robust_n)
 
         # save checkpoint
         if (epoch+1) % args.chkpt_iters == 0 or epoch+1 == epochs:
             torch.save(model.state_dict(), os.path.join(dirname, f'model_{epoch}.pth'))
             torch.save(opt.state_dict(), os.path.join(dirname, f'opt_{epoch}.pth'))
+            torch.save(scaler.state_dict(), os.path.join(dirname, f'scaler_{epoch}.pth'))
 
         # save best
         if test_robust_acc/test_robust_n > best_test_robust_acc: